@@ -11,13 +11,19 @@ Reddit Referral Poster — Pro v2.2 (US focus + responsive Stop)
 """
 
 import os
-import io
+import re
+import sys
 import csv
+import json
+import hashlib
 import time
 import random
+import sqlite3
 import threading
-import datetime as dt
-from typing import Dict, List, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Tuple
 
 from flask import (
     Flask, render_template, request, jsonify, redirect,
@@ -27,6 +33,13 @@ from flask_cors import CORS
 
 import praw
 import prawcore
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import ahocorasick  # optional: pyahocorasick
+except ImportError:  # pragma: no cover - pure-Python fallback below
+    ahocorasick = None
 
 # -------------------- Config --------------------
 
@@ -46,67 +59,118 @@ STATE: Dict = {
     "refresh_token": None,
     "running": False,
     "stop_requested": False,
-    "logs": [],
+    "logs": deque(maxlen=2000),
     "summary": {},            # per-subreddit counts
     "last_login_user": None,
+    "_lock": threading.RLock(),  # guards "logs"/"summary" against concurrent readers
+    "stop_event": threading.Event(),  # wakes the worker out of sleeps on /stop
+    "_ver": 0,                 # bumped on every logs/summary change; feeds the /progress ETag
 }
 
+_TS_CACHE = [0, ""]  # [epoch second, formatted UTC timestamp]
+
 def _log(level: str, event: str, **kwargs):
-    entry = {"level": level, "event": event, "ts": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())}
+    now = int(time.time())
+    if now != _TS_CACHE[0]:
+        _TS_CACHE[1] = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now))
+        _TS_CACHE[0] = now
+    entry = {"level": level, "event": event, "ts": _TS_CACHE[1]}
     entry.update(kwargs)
-    STATE["logs"].append(entry)
-    if len(STATE["logs"]) > 2000:
-        STATE["logs"] = STATE["logs"][-2000:]
+    with STATE["_lock"]:
+        STATE["logs"].append(entry)
+        STATE["_ver"] += 1
+
+def _set_state(**fields):
+    """Assign STATE fields together under the lock (and invalidate the /progress ETag)."""
+    with STATE["_lock"]:
+        STATE.update(fields)
+        STATE["_ver"] += 1
 
 # -------------------- Heuristics / Presets --------------------
 
-PROHIBIT_PATTERNS = [
+PROHIBIT_PATTERNS = frozenset([
     "no referrals", "no referral", "no codes", "no promo codes",
     "no self-promotion", "no self promotion", "referrals not allowed",
     "no affiliate", "no affiliate links"
-]
-MEGATHREAD_REQUIRED_PATTERNS = [
+])
+MEGATHREAD_REQUIRED_PATTERNS = frozenset([
     "referrals only in", "referrals allowed only in",
     "post referrals only in", "megathread", "weekly thread"
-]
-
-DEFAULT_ALLOWLIST = [
+])
+MEGATHREAD_FLAIR_KEYWORDS = ("referral", "referrals", "megathread")
+MEGATHREAD_FLAIR_RE = re.compile("|".join(map(re.escape, MEGATHREAD_FLAIR_KEYWORDS)), re.IGNORECASE)
+
+def _build_rules_automaton():
+    """One automaton over both pattern classes; payload is the class tag."""
+    if ahocorasick is None:
+        return None
+    A = ahocorasick.Automaton()
+    for pat in PROHIBIT_PATTERNS:
+        A.add_word(pat, ("prohibit",))
+    for pat in MEGATHREAD_REQUIRED_PATTERNS:
+        # A pattern may sit in both lists; keep both tags on the one key.
+        prev = A.get(pat, ())
+        A.add_word(pat, prev + ("mega",))
+    A.make_automaton()
+    return A
+
+_RULES_AUTOMATON = _build_rules_automaton()
+
+# Fallback when pyahocorasick is missing: one C-level alternation per class.
+_PROHIBIT_RE = re.compile("|".join(re.escape(p) for p in PROHIBIT_PATTERNS), re.IGNORECASE)
+_MEGA_RE = re.compile("|".join(re.escape(p) for p in MEGATHREAD_REQUIRED_PATTERNS), re.IGNORECASE)
+
+def _scan_rules_blob(blob: str) -> Tuple[bool, bool]:
+    """Return (disallow, mega_only) for a rules blob (any case)."""
+    if _RULES_AUTOMATON is None:
+        return bool(_PROHIBIT_RE.search(blob)), bool(_MEGA_RE.search(blob))
+    disallow = mega_only = False
+    for _, tags in _RULES_AUTOMATON.iter(blob.lower()):
+        if "prohibit" in tags:
+            disallow = True
+        if "mega" in tags:
+            mega_only = True
+        if disallow and mega_only:
+            break
+    return disallow, mega_only
+
+DEFAULT_ALLOWLIST = (
     "ReferralCodes", "ReferAFriend", "ReferralTrains", "SignUpBonuses",
     "ReferralLinks", "Referrals", "Referralcodes", "TheReferralHub",
-]
-DEFAULT_GENERIC_QUERIES = [
+)
+DEFAULT_GENERIC_QUERIES = (
     "referral", "referrals", "referral code", "referral codes",
     "promo code", "promocodes", "coupon code", "megathread", "weekly megathread"
-]
+)
 
 PRESETS = {
     "gopuff": {
         "brand": "gopuff",
-        "brand_terms": ["gopuff", "alcohol delivery", "grocery delivery"],
+        "brand_terms": ("gopuff", "alcohol delivery", "grocery delivery"),
         "allowlist": DEFAULT_ALLOWLIST,
         "generic_terms": DEFAULT_GENERIC_QUERIES,
     },
     "uber eats": {
         "brand": "uber eats",
-        "brand_terms": ["uber eats", "ubereats", "food delivery"],
+        "brand_terms": ("uber eats", "ubereats", "food delivery"),
         "allowlist": DEFAULT_ALLOWLIST,
         "generic_terms": DEFAULT_GENERIC_QUERIES,
     },
     "grubhub": {
         "brand": "grubhub",
-        "brand_terms": ["grubhub", "food delivery"],
+        "brand_terms": ("grubhub", "food delivery"),
         "allowlist": DEFAULT_ALLOWLIST,
         "generic_terms": DEFAULT_GENERIC_QUERIES,
     },
     "doordash": {
         "brand": "doordash",
-        "brand_terms": ["doordash", "food delivery"],
+        "brand_terms": ("doordash", "food delivery"),
         "allowlist": DEFAULT_ALLOWLIST,
         "generic_terms": DEFAULT_GENERIC_QUERIES,
     },
     "instacart": {
         "brand": "instacart",
-        "brand_terms": ["instacart", "grocery delivery"],
+        "brand_terms": ("instacart", "grocery delivery"),
         "allowlist": DEFAULT_ALLOWLIST,
         "generic_terms": DEFAULT_GENERIC_QUERIES,
     },
@@ -114,42 +178,148 @@ PRESETS = {
 
 # -------------------- Reddit client --------------------
 
+# Last rate-limit budget Reddit reported; refreshed from every response.
+RATELIMIT_FLOOR = 3  # pause new calls when fewer requests than this remain
+_RATE = {"remaining": None, "reset_at": 0.0}
+
+def _capture_ratelimit(resp, *args, **kwargs):
+    """requests response hook: record X-Ratelimit-Remaining/Reset."""
+    remaining = resp.headers.get("X-Ratelimit-Remaining")
+    reset = resp.headers.get("X-Ratelimit-Reset")
+    if remaining is None or reset is None:
+        return
+    try:
+        _RATE["remaining"] = float(remaining)
+        _RATE["reset_at"] = time.time() + float(reset)
+    except ValueError:
+        pass
+
+def _await_ratelimit():
+    """Block until the window resets if the remaining budget is nearly spent.
+    Wakes early on /stop."""
+    remaining = _RATE["remaining"]
+    if remaining is None or remaining >= RATELIMIT_FLOOR:
+        return
+    wait = _RATE["reset_at"] - time.time()
+    if wait > 0:
+        _log("info", "ratelimit_wait", seconds=int(wait))
+        STATE["stop_event"].wait(timeout=wait)
+
+def _make_session() -> requests.Session:
+    sess = requests.Session()
+    adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20)
+    sess.mount("https://", adapter)
+    sess.hooks["response"].append(_capture_ratelimit)
+    return sess
+
+# One keep-alive connection pool shared by every client we build.
+_SHARED_SESSION = _make_session()
+_REDDIT_CACHE: Dict[Tuple[str, bool], praw.Reddit] = {}
+
 def build_reddit(read_only=False) -> praw.Reddit:
+    """Return a Reddit client on the shared HTTP session.
+
+    Authenticated clients are cached per refresh token. Read-only clients
+    are only used for the OAuth handshake, which mutates the instance
+    (auth.authorize), so those are always built fresh."""
+    key = (STATE["refresh_token"], read_only)
+    if not read_only and key in _REDDIT_CACHE:
+        return _REDDIT_CACHE[key]
+    reddit = _new_reddit(None if read_only else STATE["refresh_token"])
+    if not read_only:
+        _REDDIT_CACHE[key] = reddit
+    return reddit
+
+def _new_reddit(refresh_token) -> praw.Reddit:
     kwargs = dict(
         client_id=REDDIT_CLIENT_ID,
         client_secret=REDDIT_CLIENT_SECRET,
         user_agent=DEFAULT_USER_AGENT,
         redirect_uri=REDDIT_REDIRECT_URI,
         ratelimit_seconds=5,
+        requestor_kwargs={"session": _SHARED_SESSION},
     )
-    if STATE["refresh_token"] and not read_only:
-        kwargs["refresh_token"] = STATE["refresh_token"]
+    if refresh_token:
+        kwargs["refresh_token"] = refresh_token
     return praw.Reddit(**kwargs)
 
-def is_megathread(submission) -> bool:
-    title = (getattr(submission, "title", "") or "").lower()
-    flair = (getattr(submission, "link_flair_text", "") or "").lower()
+_THREAD_CLIENTS = threading.local()
+
+def thread_reddit() -> praw.Reddit:
+    """Authenticated client private to the calling thread.
+
+    PRAW instances aren't thread-safe (rate limiter, token refresh), so
+    search pool threads each get their own, built from the current refresh
+    token and sharing the pooled HTTP session."""
+    token = STATE["refresh_token"]
+    cached = getattr(_THREAD_CLIENTS, "client", None)
+    if cached is None or cached[0] != token:
+        cached = (token, _new_reddit(token))
+        _THREAD_CLIENTS.client = cached
+    return cached[1]
+
+@lru_cache(maxsize=4096)
+def is_megathread_title(title_lower: str) -> bool:
+    return "megathread" in title_lower or ("weekly" in title_lower and "thread" in title_lower)
+
+def is_megathread(submission, title_lower: str = None) -> bool:
+    flair = getattr(submission, "link_flair_text", "") or ""
     if getattr(submission, "stickied", False):
         return True
-    if "megathread" in title or ("weekly" in title and "thread" in title):
+    if title_lower is None:
+        title_lower = (getattr(submission, "title", "") or "").lower()
+    if is_megathread_title(title_lower):
         return True
-    if flair and any(k in flair for k in ["referral", "referrals", "megathread"]):
+    if flair and MEGATHREAD_FLAIR_RE.search(flair):
         return True
     return False
 
-def rules_disallow_referrals(subreddit) -> Tuple[bool, bool, str]:
-    """Return (disallowed, megathread_only, memo)."""
+def _sidebar_text(subreddit) -> str:
+    """Sidebar text, read from the object when already loaded (subreddits.search
+    results are); only lazy subreddits pay for the /about fetch."""
+    return vars(subreddit).get("description") or subreddit.description or ""
+
+def _rule_texts(subreddit, reddit=None) -> List[str]:
+    """Rule names/descriptions from one raw GET of /about/rules.
+
+    HTTP errors (403/404 etc.) propagate; PRAW's rules listing is only used
+    when the response isn't the expected shape."""
+    _await_ratelimit()
+    client = reddit or subreddit._reddit
+    data = client.request(method="GET", path=f"/r/{subreddit.display_name}/about/rules")
+    try:
+        return [f"{r.get('short_name') or ''} {r.get('description') or ''}"
+                for r in data.get("rules", [])]
+    except (AttributeError, TypeError):
+        return [f"{r.short_name or ''} {r.description or ''}" for r in subreddit.rules()]
+
+RULES_CACHE_TTL = int(os.environ.get("RULES_CACHE_TTL", 21600))  # seconds
+# Built-in referral subs exist to host referrals; don't spend API calls on their rules.
+_KNOWN_ALLOW = frozenset(name.lower() for name in DEFAULT_ALLOWLIST)
+_RULES_CACHE: Dict[str, Tuple[float, Tuple[bool, bool, str]]] = {}
+
+def rules_disallow_referrals(subreddit, reddit=None) -> Tuple[bool, bool, str]:
+    """Return (disallowed, megathread_only, memo).
+
+    Successful checks are cached per subreddit for RULES_CACHE_TTL seconds,
+    so repeated drip cycles don't refetch the same rules."""
+    key = subreddit.display_name.lower()
+    if key in _KNOWN_ALLOW:
+        return False, False, "allowlisted_skip"
+    now = time.time()
+    hit = _RULES_CACHE.get(key)
+    if hit and now - hit[0] < RULES_CACHE_TTL:
+        return hit[1]
     try:
-        text_blobs = []
-        for r in subreddit.rules():
-            text_blobs.append(f"{r.short_name or ''} {r.description or ''}")
-        about = subreddit.description or ""
-        text_blobs.append(about)
-        blob = " ".join(text_blobs).lower()
-
-        disallow = any(pat in blob for pat in PROHIBIT_PATTERNS)
-        mega_only = any(pat in blob for pat in MEGATHREAD_REQUIRED_PATTERNS)
-        return disallow, mega_only, "rules_checked"
+        # The sidebar alone is often conclusive; only fetch rules when it doesn't
+        # already prohibit referrals.
+        disallow, mega_only = _scan_rules_blob(_sidebar_text(subreddit))
+        if not disallow:
+            r_disallow, r_mega = _scan_rules_blob(" ".join(_rule_texts(subreddit, reddit)))
+            disallow, mega_only = r_disallow, mega_only or r_mega
+        result = (disallow, mega_only, "rules_checked")
+        _RULES_CACHE[key] = (now, result)
+        return result
     except Exception as e:
         return False, False, f"rules_error:{e!r}"
 
@@ -159,12 +329,15 @@ US_POS = [" us ", " usa ", " united states", "$", "usd"]
 NON_US_NEG = [" uk ", " united kingdom", " gb ", " canada", " ca ", " australia", " au ",
               " eu ", " europe", " €", " eur", " £", " gbp", " cad", " aud"]
 
-def passes_region_us(subreddit, submission) -> bool:
+def passes_region_us(subreddit, submission, title_lower: str = None) -> bool:
     """Heuristic: prefer US; skip obvious non-US. Checks title, flair, subreddit desc."""
-    try:
-        title = (submission.title or "").lower()
-    except Exception:
-        title = ""
+    if title_lower is not None:
+        title = title_lower
+    else:
+        try:
+            title = (submission.title or "").lower()
+        except Exception:
+            title = ""
     flair = (getattr(submission, "link_flair_text", "") or "").lower()
     about = (getattr(subreddit, "description", "") or "").lower()
 
@@ -177,67 +350,219 @@ def passes_region_us(subreddit, submission) -> bool:
 
 # -------------------- Search --------------------
 
-def find_candidate_threads(reddit, brand_terms: List[str], generic_terms: List[str],
-                           allowlist: List[str], days_back: int, region: str):
-    """Yield (sub_name, submission, disallow, mega_only)"""
-    cutoff = time.time() - days_back * 86400
-    seen = set()
-
-    def region_ok(sr, subm) -> bool:
-        if region.lower() == "us":
-            return passes_region_us(sr, subm)
-        return True
-
-    # 1) Search allowlisted subs first
-    for s in allowlist:
+TITLE_KEYWORD_RE = re.compile(r"referrals?|promo|code|coupon|discount|megathread", re.IGNORECASE)
+CANDIDATE_REFILL_SECONDS = 900  # re-run searches at most this often while the queue has items
+CANDIDATE_REFILL_MIN_SECONDS = 120  # floor between refills when the queue keeps running dry
+CANDIDATE_QUEUE_MAX = 200  # refills keep a uniform sample of at most this many candidates
+SEARCH_WORKERS = 8  # concurrent batch scans; PRAW's own rate limiter still applies
+# Long-lived so each thread's client (and its access token) survives across refills.
+_SEARCH_POOL = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="search")
+SEARCH_BATCH_SIZE = 10  # subs per r/a+b+c search, keeps the URL well under length limits
+SEARCH_RESULT_CAP = 250  # Reddit stops paging a search listing around here
+PULLPUSH_MAX_SIZE = 100
+_SEEN_LOCK = threading.Lock()
+
+class Candidate(NamedTuple):
+    """A search hit; `title_lower` is computed once and reused by later filters."""
+    sub: str
+    submission: "praw.models.Submission"
+    title_lower: str
+    disallow: bool
+    mega_only: bool
+
+def _submission_matches(subm, title_lower, seen, s, cutoff, region_ok, title_re) -> bool:
+    """Shared per-submission filter: age, dedup, region, title keywords."""
+    if subm.created_utc < cutoff:
+        return False
+    with _SEEN_LOCK:
+        if (s, subm.id) in seen:
+            return False
+    if not region_ok(subm, title_lower):
+        _log("info", "skip_region", sub=s, title=subm.title)
+        return False
+    with _SEEN_LOCK:
+        if (s, subm.id) in seen:
+            return False
+        seen.add((s, subm.id))
+    return bool(title_re.search(title_lower))
+
+PULLPUSH_URL = "https://api.pullpush.io/reddit/search/submission/"
+DISCOVERY_BACKENDS = ("reddit", "pullpush")
+
+def _pullpush_search(reddit, names: List[str], terms: Tuple[str, ...],
+                     cutoff: float, limit: int):
+    """Find submission ids via the Pushshift-compatible PullPush API, then
+    hydrate them through PRAW (reddit.info batches 100 fullnames per call)."""
+    params = {
+        "subreddit": ",".join(names),
+        "after": int(cutoff),
+        "size": min(limit, PULLPUSH_MAX_SIZE),
+        "sort": "desc",
+        "sort_type": "created_utc",
+    }
+    if terms:
+        params["title"] = "|".join(f'"{t}"' for t in terms)
+    resp = _SHARED_SESSION.get(PULLPUSH_URL, params=params, timeout=30)
+    resp.raise_for_status()
+    ids = [d["id"] for d in resp.json().get("data", []) if d.get("id")]
+    if not ids:
+        return []
+    _await_ratelimit()
+    # Hydrate here so errors surface inside _search_batch's fallback.
+    return list(reddit.info(fullnames=[f"t3_{i}" for i in ids]))
+
+def _search_batch(reddit, names: List[str], query: str, terms: Tuple[str, ...],
+                  cutoff: float, limit: int, backend: str):
+    """Submissions for a batch of subs from the chosen backend.
+    PullPush failures fall back to Reddit search."""
+    if backend == "pullpush":
         try:
-            sr = reddit.subreddit(s)
-            disallow, mega_only, _ = rules_disallow_referrals(sr)
-            q_terms = brand_terms + generic_terms
-            query = " OR ".join([f'title:"{t}"' for t in q_terms if t])
-            for subm in sr.search(query or "referral", sort="new", time_filter="year", limit=50):
-                if subm.created_utc < cutoff:
-                    continue
-                if (s, subm.id) in seen:
-                    continue
-                if not region_ok(sr, subm):
-                    _log("info", "skip_region", sub=s, title=subm.title)
-                    continue
-                seen.add((s, subm.id))
-                title = (subm.title or "").lower()
-                if any(k in title for k in ["referral", "referrals", "promo", "code", "coupon", "discount", "megathread"]):
-                    yield (s, subm, disallow, mega_only)
+            return _pullpush_search(reddit, names, terms, cutoff, limit)
         except Exception as e:
-            _log("warn", "allowlist_search_error", sub=s, error=repr(e))
+            _log("warn", "pullpush_error", sub="+".join(names), error=repr(e))
+    _await_ratelimit()
+    return reddit.subreddit("+".join(names)).search(
+        query, sort="new", time_filter="year", limit=limit
+    )
+
+def _scan_subreddits(reddit, subs: Dict[str, "praw.models.Subreddit"], query: str,
+                     cutoff: float, seen: set, limit: int, region: str,
+                     title_re=TITLE_KEYWORD_RE, backend: str = "reddit",
+                     terms: Tuple[str, ...] = ()):
+    """Yield a Candidate for each matching submission in a batch of subs.
+
+    `subs` maps lowercased name -> Subreddit and `limit` is the per-sub result
+    budget. The batch is searched as one multireddit (r/a+b+c) and results are
+    demultiplexed by subreddit; rules are only checked for subs that actually
+    produced a match.
+
+    The multireddit shares one listing (capped at SEARCH_RESULT_CAP), so a busy
+    sub can crowd out the others. When that listing comes back full, subs that
+    got no results at all are searched again on their own."""
+    rules: Dict[str, Tuple[bool, bool, str]] = {}
+    hits: Dict[str, int] = {}
+
+    def scan(results):
+        for subm in results:
+            key = subm.subreddit.display_name.lower()
+            hits[key] = hits.get(key, 0) + 1
+            sr = subs.get(key, subm.subreddit)
+            s = sr.display_name
+
+            def region_ok(x, title_lower) -> bool:
+                if region.lower() == "us":
+                    return passes_region_us(sr, x, title_lower)
+                return True
+
+            title_lower = (subm.title or "").lower()
+            if not _submission_matches(subm, title_lower, seen, s, cutoff, region_ok, title_re):
+                continue
+            if key not in rules:
+                rules[key] = rules_disallow_referrals(sr, reddit)
+            disallow, mega_only, _ = rules[key]
+            yield Candidate(s, subm, title_lower, disallow, mega_only)
+
+    names = [sr.display_name for sr in subs.values()]
+    batch_limit = min(limit * len(names), SEARCH_RESULT_CAP)
+    yield from scan(_search_batch(reddit, names, query, terms, cutoff, batch_limit, backend))
+    full = min(batch_limit, PULLPUSH_MAX_SIZE) if backend == "pullpush" else batch_limit
+    if len(names) > 1 and sum(hits.values()) >= full:
+        for key, sr in subs.items():
+            if key not in hits:
+                yield from scan(_search_batch(reddit, [sr.display_name], query, terms,
+                                              cutoff, limit, backend))
+
+def _rebind_subreddit(reddit, sr) -> "praw.models.Subreddit":
+    """`sr` on `reddit`. Listing results (subreddits.search) carry their data but
+    are built with _fetched=False, so test for loaded fields instead."""
+    data = vars(sr)
+    if "description" not in data:
+        return reddit.subreddit(sr.display_name)
+    return praw.models.Subreddit(
+        reddit, _data={k: v for k, v in data.items() if not k.startswith("_")}
+    )
+
+def _collect_subreddits(subs: Dict[str, "praw.models.Subreddit"], query: str,
+                        cutoff: float, seen: set, limit: int, region: str,
+                        error_event: str, backend: str = "reddit",
+                        terms: Tuple[str, ...] = ()) -> List[Tuple]:
+    """Run _scan_subreddits to completion (for the thread pool), logging failures.
+
+    Runs on this thread's own client: every sub is re-created on it, carrying
+    over the loaded data of discovery results so their sidebar isn't refetched.
+    Matches gathered before a failure are still returned, since they're
+    already marked in `seen` and wouldn't come back on a later refill."""
+    reddit = thread_reddit()
+    subs = {k: _rebind_subreddit(reddit, sr) for k, sr in subs.items()}
+    found = []
+    try:
+        for cand in _scan_subreddits(reddit, subs, query, cutoff, seen, limit, region,
+                                     backend=backend, terms=terms):
+            found.append(cand)
+    except Exception as e:
+        _log("warn", error_event, sub="+".join(sr.display_name for sr in subs.values()),
+             error=repr(e))
+    return found
+
+@lru_cache(maxsize=32)
+def _build_query(terms: Tuple[str, ...]) -> str:
+    """Title OR-query for a term list; memoized since a run's terms never change."""
+    return " OR ".join(f'title:"{t}"' for t in terms) or "referral"
+
+def _batches(subs: Dict[str, "praw.models.Subreddit"], size: int):
+    items = list(subs.items())
+    for i in range(0, len(items), size):
+        yield dict(items[i:i + size])
+
+def find_candidate_threads(reddit, terms: Tuple[str, ...], query: str,
+                           allowlist: List[str], days_back: int, region: str,
+                           seen: set = None, backend: str = "reddit"):
+    """Yield Candidate(sub, submission, title_lower, disallow, mega_only).
+
+    `terms` are the deduplicated discovery terms and `query` the title
+    OR-query built from them (see _build_query); both are fixed per run.
+
+    Subreddits are searched in multireddit batches of SEARCH_BATCH_SIZE,
+    concurrently, so results arrive in completion order. Pass a long-lived
+    `seen` set to skip submissions already yielded by an earlier call.
+    `backend="pullpush"` finds submissions via PullPush instead of Reddit
+    search (see DISCOVERY_BACKENDS)."""
+    cutoff = time.time() - days_back * 86400
+    if seen is None:
+        seen = set()
 
-    # 2) Discovery by brand/generic terms
-    discovery = list(dict.fromkeys(brand_terms + generic_terms))
-    for q in discovery:
+    # 1) Allowlisted subs start scanning while discovery runs
+    allowed: Dict[str, "praw.models.Subreddit"] = {}
+    for s in allowlist:
+        allowed.setdefault(s.lower(), reddit.subreddit(s))
+    futures = [
+        _SEARCH_POOL.submit(_collect_subreddits, batch, query, cutoff, seen,
+                            50, region, "allowlist_search_error", backend, terms)
+        for batch in _batches(allowed, SEARCH_BATCH_SIZE)
+    ]
+
+    # 2) Discovery by brand/generic terms; collect unique subs across queries first
+    discovered: Dict[str, "praw.models.Subreddit"] = {}
+    for q in terms:
+        _await_ratelimit()
         try:
             for sr in reddit.subreddits.search(q, limit=25):
-                s = sr.display_name
-                if any(s.lower() == a.lower() for a in allowlist):
+                key = sr.display_name.lower()
+                if key in allowed or key in discovered:
                     continue
-                disallow, mega_only, _ = rules_disallow_referrals(sr)
-                query = " OR ".join([f'title:"{t}"' for t in (brand_terms + generic_terms) if t])
-                try:
-                    for subm in sr.search(query or "referral", sort="new", time_filter="year", limit=25):
-                        if subm.created_utc < cutoff:
-                            continue
-                        if (s, subm.id) in seen:
-                            continue
-                        if not region_ok(sr, subm):
-                            _log("info", "skip_region", sub=s, title=subm.title)
-                            continue
-                        seen.add((s, subm.id))
-                        title = (subm.title or "").lower()
-                        if any(k in title for k in ["referral", "referrals", "promo", "code", "coupon", "discount", "megathread"]):
-                            yield (s, subm, disallow, mega_only)
-                except Exception as inner:
-                    _log("warn", "subreddit_search_error", sub=s, error=repr(inner))
+                discovered[key] = sr
         except Exception as e:
             _log("warn", "discovery_error", query=q, error=repr(e))
 
+    futures += [
+        _SEARCH_POOL.submit(_collect_subreddits, batch, query, cutoff, seen,
+                            25, region, "subreddit_search_error", backend, terms)
+        for batch in _batches(discovered, SEARCH_BATCH_SIZE)
+    ]
+
+    for fut in as_completed(futures):
+        yield from fut.result()
+
 # -------------------- Copy variation engine --------------------
 
 SYNONYMS = {
@@ -251,42 +576,53 @@ SYNONYMS = {
     "hope_helps": ["hope this helps", "hope this is useful", "might help someone"],
     "link_phrase": ["Here’s the link", "Direct link", "Sign-up link", "My link"],
 }
-CTA_TEMPLATES = [
+CTA_TEMPLATES = (
     "{get} {discount}% off your {first_order} — {use_code} {code} {at_checkout}.",
     "Score {discount}% off your {first_order} with code {code} {at_checkout}.",
     "{get} {discount}% off: code {code} {at_checkout}.",
-]
-OPENERS = [
+)
+OPENERS = (
     "{hey}! {brand} {delivers} alcohol, food, drinks and {more} in ~30 minutes.",
     "{hey}! If you’re trying {brand} for the first time, this might help.",
     "{hey}! Sharing a {brand} referral that helped me recently:",
-]
-CLOSERS = [
+)
+CLOSERS = (
     "{hope_helps}. {link_phrase}: {link}",
     "{link_phrase}: {link} — {hope_helps}.",
     "{link} ({hope_helps}).",
-]
+)
+
+SYNONYMS = {k: tuple(sys.intern(x) for x in v) for k, v in SYNONYMS.items()}
+_TLS = threading.local()
+
+def _rng() -> random.Random:
+    """Per-thread Random, so the worker, refill and request threads don't
+    share the module-level generator's state."""
+    r = getattr(_TLS, "rng", None)
+    if r is None:
+        r = _TLS.rng = random.Random()
+    return r
+
+class _SpinFields(dict):
+    """format_map mapping that draws a synonym only for fields the template uses."""
+    def __missing__(self, key):
+        pool = SYNONYMS.get(key)
+        if pool is None:
+            raise KeyError(key)
+        val = self[key] = _rng().choice(pool)
+        return val
 
 def spin_piece(key: str) -> str:
-    vals = SYNONYMS.get(key, [key])
-    return random.choice(vals)
+    vals = SYNONYMS.get(key, (key,))
+    return _rng().choice(vals)
 
 def spin_template(tmpl: str, brand: str, code: str, link: str, discount: int) -> str:
-    return tmpl.format(
-        hey=spin_piece("hey"),
+    return tmpl.format_map(_SpinFields(
         brand=(brand or "").strip().title() or "This service",
-        delivers=spin_piece("delivers"),
-        more=spin_piece("more"),
-        get=spin_piece("get"),
-        first_order=spin_piece("first_order"),
-        use_code=spin_piece("use_code"),
-        at_checkout=spin_piece("at_checkout"),
-        hope_helps=spin_piece("hope_helps"),
-        link_phrase=spin_piece("link_phrase"),
         code=code,
         link=link,
         discount=discount,
-    )
+    ))
 
 def generate_variant(base: str, brand: str, code: str, link: str, discount: int,
                      tone: str, emoji_level: str, add_disclaimer: bool) -> str:
@@ -294,19 +630,25 @@ def generate_variant(base: str, brand: str, code: str, link: str, discount: int,
     if base.strip():
         parts.append(base.strip())
 
-    opener = spin_template(random.choice(OPENERS), brand, code, link, discount)
-    cta = spin_template(random.choice(CTA_TEMPLATES), brand, code, link, discount)
-    closer = spin_template(random.choice(CLOSERS), brand, code, link, discount)
+    # One draw picks all three templates uniformly (mixed-radix decode).
+    n = _rng().randrange(len(OPENERS) * len(CTA_TEMPLATES) * len(CLOSERS))
+    n, i_open = divmod(n, len(OPENERS))
+    i_close, i_cta = divmod(n, len(CTA_TEMPLATES))
 
+    cta = spin_template(CTA_TEMPLATES[i_cta], brand, code, link, discount)
     if tone == "concise":
         msg = f"{cta}\n\n{link}"
-    elif tone == "friendly":
-        msg = f"{opener}\n\n{cta}\n\n{closer}"
     else:
-        msg = (
-            f"{opener}\n\n{cta}\n\n"
-            f"If you don’t see the code field, sign up first, then add it {spin_piece('at_checkout')}. {closer}"
-        )
+        # Opener/closer only appear in the longer tones; skip spinning them otherwise.
+        opener = spin_template(OPENERS[i_open], brand, code, link, discount)
+        closer = spin_template(CLOSERS[i_close], brand, code, link, discount)
+        if tone == "friendly":
+            msg = f"{opener}\n\n{cta}\n\n{closer}"
+        else:
+            msg = (
+                f"{opener}\n\n{cta}\n\n"
+                f"If you don’t see the code field, sign up first, then add it {spin_piece('at_checkout')}. {closer}"
+            )
 
     parts.append(msg)
 
@@ -315,48 +657,91 @@ def generate_variant(base: str, brand: str, code: str, link: str, discount: int,
 
     final = "\n\n".join(parts)
     if emoji_level == "low":
-        if random.random() < 0.35: final += " 🙂"
+        if _rng().random() < 0.35: final += " 🙂"
     elif emoji_level == "normal":
-        if random.random() < 0.2: final += " 🚚"
+        if _rng().random() < 0.2: final += " 🚚"
     return final.strip()
 
 # -------------------- Sleep helper --------------------
 
 def _interruptible_sleep(seconds: int) -> bool:
-    """Sleep up to `seconds`, checking stop flag every 1s.
+    """Sleep up to `seconds`, waking immediately if a stop is requested.
     Returns True if a stop was requested during the wait."""
-    for _ in range(max(1, int(seconds))):
-        if STATE.get("stop_requested"):
-            return True
-        time.sleep(1)
-    return False
+    return STATE["stop_event"].wait(timeout=max(0, seconds))
+
+# -------------------- Posted-target store --------------------
+
+POSTED_DB = os.environ.get("POSTED_DB", "state.db")
+POSTED_RETENTION_DAYS = 30
+
+def _open_posted_db():
+    """Open the sqlite file recording threads we've replied to, or None if unavailable."""
+    try:
+        conn = sqlite3.connect(POSTED_DB, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS posted("
+            "sub TEXT, subm_id TEXT, ts REAL, PRIMARY KEY(sub, subm_id))"
+        )
+        return conn
+    except sqlite3.Error as e:
+        _log("warn", "posted_db_error", error=repr(e))
+        return None
+
+def _load_posted(conn) -> set:
+    """Submission ids replied to within POSTED_RETENTION_DAYS; older rows are pruned.
+
+    Keyed on the id alone: the sub name is as typed in the allowlist, so its
+    casing can differ between runs."""
+    if conn is None:
+        return set()
+    since = time.time() - POSTED_RETENTION_DAYS * 86400
+    try:
+        conn.execute("DELETE FROM posted WHERE ts <= ?", (since,))
+        rows = conn.execute("SELECT subm_id FROM posted").fetchall()
+    except sqlite3.Error as e:
+        _log("warn", "posted_db_error", error=repr(e))
+        return set()
+    return {subm_id for (subm_id,) in rows}
+
+def _record_posted(conn, sub: str, subm_id: str):
+    if conn is None:
+        return
+    try:
+        conn.execute("INSERT OR IGNORE INTO posted VALUES (?, ?, ?)", (sub.lower(), subm_id, time.time()))
+    except sqlite3.Error as e:
+        _log("warn", "posted_db_error", error=repr(e))
 
 # -------------------- Worker --------------------
 
 def drip_worker(config: Dict):
-    STATE["running"] = True
-    STATE["stop_requested"] = False
-    STATE["summary"] = {}
+    _set_state(running=True, stop_requested=False, summary={})
+    STATE["stop_event"].clear()
     posted = 0
-    seen_targets = {}
+    # Threads replied to in earlier runs (survives restarts) plus this run's picks.
+    posted_db = _open_posted_db()
+    seen_targets = _load_posted(posted_db)
     per_sub_counts = {}
+    refill_wanted = threading.Event()
+    worker_done = threading.Event()
 
     try:
+        refill_seed = None
         if config.get("random_seed"):
-            random.seed(int(config["random_seed"]))
+            _rng().seed(int(config["random_seed"]))
+            # The refill thread has its own generator; derive its seed from the job's.
+            refill_seed = _rng().getrandbits(64)
 
         reddit = build_reddit(read_only=False)
         try:
             me = str(reddit.user.me())
-            STATE["last_login_user"] = me
+            _set_state(last_login_user=me)
             _log("info", "auth_ok", user=me)
         except prawcore.exceptions.OAuthException as e:
             _log("error", "auth_failed", reason="OAuthException", detail=str(e))
-            STATE["running"] = False
             return
         except prawcore.exceptions.PrawcoreException as e:
             _log("error", "auth_failed", reason="PrawcoreException", detail=str(e))
-            STATE["running"] = False
             return
 
         # --- Inputs ---
@@ -378,6 +763,9 @@ def drip_worker(config: Dict):
             brand_terms.append(brand)
         generic_terms = [t.strip() for t in (config.get("generic_terms") or "").split(",") if t.strip()] or DEFAULT_GENERIC_QUERIES
         allowlist = [s.strip() for s in (config.get("allowlist") or "").split(",") if s.strip()] or DEFAULT_ALLOWLIST
+        # Search terms and the title query never change during a run; build them once.
+        terms = tuple(dict.fromkeys(t for t in (*brand_terms, *generic_terms) if t))
+        query = _build_query(terms)
 
         days_back = int(config.get("days_back", 60))
         per_sub_limit = int(config.get("per_sub_limit", 1))
@@ -388,12 +776,73 @@ def drip_worker(config: Dict):
         jitter = int(config.get("jitter_seconds", 30))
 
         duration_minutes = int(config.get("duration_minutes", 60))
-        start_at = dt.datetime.utcnow()
-        end_at = start_at + dt.timedelta(minutes=duration_minutes)
+        deadline = time.monotonic() + duration_minutes * 60
 
         only_megathreads = bool(config.get("only_megathreads", True))
         dry_run = bool(config.get("dry_run", False))
         region = (config.get("region") or "US").upper()
+        backend = (config.get("discovery_backend") or "reddit").lower()
+        if backend not in DISCOVERY_BACKENDS:
+            backend = "reddit"
+
+        # --- Candidate refill (background) ---
+        # Discovery runs on its own thread every CANDIDATE_REFILL_SECONDS, or
+        # sooner (but no more often than CANDIDATE_REFILL_MIN_SECONDS) when the
+        # drip loop drains the queue; the loop itself only pops.
+        # `seen` persists so refills only add new submissions; matches that
+        # don't fit the queue are taken back out so a later refill can offer them.
+        seen = set()
+        candidates = []
+        pool_lock = threading.Lock()
+
+        def unsee(dropped):
+            with _SEEN_LOCK:
+                seen.difference_update((s, subm.id) for s, subm in dropped)
+
+        def refill_loop():
+            if refill_seed is not None:
+                _rng().seed(refill_seed)
+            while not worker_done.is_set():
+                started = time.monotonic()
+                fresh = []  # reservoir sample (Algorithm R) of this refill's matches
+                n = 0
+                try:
+                    # Discovery gets this thread's own client; `reddit` stays the poster's.
+                    for cand in find_candidate_threads(
+                        thread_reddit(), terms, query, allowlist, days_back, region,
+                        seen=seen, backend=backend
+                    ):
+                        if worker_done.is_set():
+                            return
+                        s, submission = cand.sub, cand.submission
+                        if cand.disallow:
+                            _log("info", "skip_rules_disallow", sub=s, title=submission.title)
+                            continue
+                        if ((only_megathreads or cand.mega_only)
+                                and not is_megathread(submission, cand.title_lower)):
+                            _log("info", "skip_not_megathread", sub=s, title=submission.title)
+                            continue
+                        n += 1
+                        if len(fresh) < CANDIDATE_QUEUE_MAX:
+                            fresh.append((s, submission))
+                        else:
+                            j = _rng().randrange(n)
+                            if j < CANDIDATE_QUEUE_MAX:
+                                fresh[j], (s, submission) = (s, submission), fresh[j]
+                            unsee([(s, submission)])
+                except Exception as e:
+                    _log("warn", "refill_error", error=repr(e))
+                with pool_lock:
+                    candidates.extend(fresh)
+                    _rng().shuffle(candidates)
+                    unsee(candidates[CANDIDATE_QUEUE_MAX:])
+                    del candidates[CANDIDATE_QUEUE_MAX:]
+                refill_wanted.clear()
+                refill_wanted.wait(timeout=CANDIDATE_REFILL_SECONDS)
+                # An empty queue asks again every few seconds; don't re-search that fast.
+                worker_done.wait(timeout=max(0, CANDIDATE_REFILL_MIN_SECONDS - (time.monotonic() - started)))
+
+        threading.Thread(target=refill_loop, daemon=True).start()
 
         # --- Main loop ---
         while True:
@@ -401,54 +850,48 @@ def drip_worker(config: Dict):
                 _log("warn", "stop_requested")
                 break
 
-            now = dt.datetime.utcnow()
-            if now > end_at:
+            if time.monotonic() > deadline:
                 _log("info", "end_time_reached")
                 break
 
-            # Gather candidates
-            candidates = []
-            for s, submission, disallow, mega_only in find_candidate_threads(
-                reddit, brand_terms, generic_terms, allowlist, days_back, region
-            ):
-                if disallow:
-                    _log("info", "skip_rules_disallow", sub=s, title=submission.title)
-                    continue
-                if (only_megathreads or mega_only) and not is_megathread(submission):
-                    _log("info", "skip_not_megathread", sub=s, title=submission.title)
-                    continue
-                if per_sub_counts.get(s, 0) >= per_sub_limit:
-                    continue
-                key = f"{s}_{submission.id}"
-                if seen_targets.get(key):
-                    continue
-                candidates.append((s, submission))
+            # Per-sub counts grow as we post, so apply the limits on pop
+            picked = None
+            with pool_lock:
+                while candidates:
+                    s, submission = candidates.pop()
+                    if per_sub_counts.get(s, 0) >= per_sub_limit:
+                        continue
+                    if submission.id in seen_targets:
+                        continue
+                    picked = (s, submission)
+                    break
 
-            if not candidates:
+            if picked is None:
+                refill_wanted.set()
                 if _interruptible_sleep(5):
                     _log("warn", "stop_requested")
                     break
                 continue
 
-            s, submission = random.choice(candidates)
-            seen_targets[f"{s}_{submission.id}"] = True
+            s, submission = picked
+            seen_targets.add(submission.id)
 
             try:
                 title = submission.title
-                # Build message (auto-generate when base is empty)
-                if base_message:
-                    msg = generate_variant(base_message, brand, code, link, discount, tone, emoji_level, add_disclaimer)
-                else:
-                    seed = f"{brand} referral"
-                    msg = generate_variant(seed, brand, code, link, discount, tone, emoji_level, add_disclaimer)
-
                 if dry_run:
                     _log("info", "dry_run_match", sub=s, title=title, url=f"https://www.reddit.com{submission.permalink}")
                 else:
-                    reply = submission.reply(msg)
+                    # Build message (auto-generate when base is empty)
+                    seed = base_message or f"{brand} referral"
+                    msg = generate_variant(seed, brand, code, link, discount, tone, emoji_level, add_disclaimer)
+                    # Candidates are bound to a search-pool thread's client; post from ours.
+                    reply = reddit.submission(id=submission.id).reply(msg)
+                    _record_posted(posted_db, s, submission.id)
                     posted += 1
                     per_sub_counts[s] = per_sub_counts.get(s, 0) + 1
-                    STATE["summary"][s] = per_sub_counts[s]
+                    with STATE["_lock"]:
+                        STATE["summary"][s] = per_sub_counts[s]
+                        STATE["_ver"] += 1
                     _log("success", "comment_posted", sub=s, title=title,
                          comment_id=getattr(reply, "id", "?"),
                          url=f"https://www.reddit.com{getattr(reply, 'permalink', '')}")
@@ -460,33 +903,44 @@ def drip_worker(config: Dict):
             except Exception as e:
                 _log("error", "post_failed", sub=s, title=title, error=repr(e))
 
-            delay = cadence_seconds + random.randint(0, jitter)
+            delay = cadence_seconds + _rng().randint(0, jitter)
             _log("info", "sleep", seconds=delay)
-            if _interruptible_sleep(delay):
+            # Don't sleep past the end of the run; the loop top ends it on wake.
+            if _interruptible_sleep(min(delay, max(0, deadline - time.monotonic()))):
                 _log("warn", "stop_requested")
                 break
 
     finally:
-        STATE["running"] = False
+        worker_done.set()
+        refill_wanted.set()  # wake the refill thread so it can exit
+        if posted_db is not None:
+            posted_db.close()
+        _set_state(running=False)
         _log("info", "job_done", running=False)
 
 # -------------------- Routes --------------------
 
+# PRESETS and the OAuth env vars are fixed for the life of the process.
+_PRESET_NAMES = sorted(PRESETS.keys())
+_PRESETS_JSON = json.dumps(PRESETS)
+_PRESETS_ETAG = hashlib.sha1(_PRESETS_JSON.encode("utf-8")).hexdigest()
+_OAUTH_READY = bool(REDDIT_CLIENT_ID and REDDIT_CLIENT_SECRET and REDDIT_REDIRECT_URI)
+
 @app.route("/")
 def index():
-    presets = sorted(PRESETS.keys())
-    use_oauth_ready = bool(REDDIT_CLIENT_ID and REDDIT_CLIENT_SECRET and REDDIT_REDIRECT_URI)
     return render_template(
         "index.html",
-        presets=presets,
-        use_oauth_ready=use_oauth_ready,
+        presets=_PRESET_NAMES,
+        use_oauth_ready=_OAUTH_READY,
         logged_in=bool(STATE["refresh_token"]),
         user=STATE.get("last_login_user")
     )
 
 @app.route("/presets.json")
 def presets_json():
-    return jsonify(PRESETS)
+    resp = Response(_PRESETS_JSON, mimetype="application/json")
+    resp.set_etag(_PRESETS_ETAG)
+    return resp.make_conditional(request)
 
 @app.route("/oauth/login")
 def oauth_login():
@@ -510,67 +964,95 @@ def oauth_callback():
         return "Invalid state or missing code", 400
     reddit = build_reddit(read_only=True)
     refresh_token = reddit.auth.authorize(code)
-    STATE["refresh_token"] = refresh_token
+    _set_state(refresh_token=refresh_token)
+    _REDDIT_CACHE.clear()
     try:
         me = str(build_reddit(read_only=False).user.me())
-        STATE["last_login_user"] = me
+        _set_state(last_login_user=me)
     except Exception:
         pass
     return redirect(url_for("index"))
 
 @app.route("/logout")
 def logout():
-    STATE["refresh_token"] = None
-    STATE["last_login_user"] = None
+    _set_state(refresh_token=None, last_login_user=None)
+    _REDDIT_CACHE.clear()
     return redirect(url_for("index"))
 
 @app.route("/start", methods=["POST"])
 def start():
-    if STATE["running"]:
-        return jsonify({"ok": False, "error": "A job is already running."}), 400
-    if not STATE["refresh_token"]:
-        return jsonify({"ok": False, "error": "Not logged in via Reddit OAuth."}), 401
-
-    data = request.json or {}
+    data = request.get_json(silent=True) or {}
     # Allow empty message; worker will auto-generate
     for k in ["message", "brand", "ref_code", "ref_link", "discount"]:
         data.setdefault(k, "")
     # Default region
     data["region"] = (data.get("region") or "US").upper()
 
-    t = threading.Thread(target=drip_worker, args=(data,), daemon=True)
-    t.start()
+    # Check-and-claim under the lock so two concurrent /start calls can't both launch a worker.
+    with STATE["_lock"]:
+        if STATE["running"]:
+            return jsonify({"ok": False, "error": "A job is already running."}), 400
+        if not STATE["refresh_token"]:
+            return jsonify({"ok": False, "error": "Not logged in via Reddit OAuth."}), 401
+        _set_state(running=True)
+
+    try:
+        t = threading.Thread(target=drip_worker, args=(data,), daemon=True)
+        t.start()
+    except Exception:
+        _set_state(running=False)
+        raise
     return jsonify({"ok": True})
 
 @app.route("/stop", methods=["POST"])
 def stop():
-    STATE["stop_requested"] = True
+    _set_state(stop_requested=True)
+    STATE["stop_event"].set()
     return jsonify({"ok": True})
 
 @app.route("/progress")
 def progress():
-    return jsonify({
-        "running": STATE["running"],
-        "stop_requested": STATE["stop_requested"],
-        "logs": STATE["logs"],
-        "summary": STATE["summary"],
-        "user": STATE.get("last_login_user"),
-        "logged_in": bool(STATE["refresh_token"]),
-    })
+    with STATE["_lock"]:
+        # The scalar flags change without a log entry (e.g. /stop, logout),
+        # so they are part of the tag alongside the version counter.
+        etag = 'W/"{}-{:d}{:d}{:d}"'.format(
+            STATE["_ver"], STATE["running"], STATE["stop_requested"], bool(STATE["refresh_token"])
+        )
+        if request.headers.get("If-None-Match") == etag:
+            return Response(status=304, headers={"ETag": etag})
+        snap = {
+            "running": STATE["running"],
+            "stop_requested": STATE["stop_requested"],
+            "logs": list(STATE["logs"]),
+            "summary": dict(STATE["summary"]),
+            "user": STATE.get("last_login_user"),
+            "logged_in": bool(STATE["refresh_token"]),
+        }
+    resp = jsonify(snap)
+    resp.headers["ETag"] = etag
+    return resp
+
+class _Echo:
+    """File-like sink that hands each written CSV line straight back."""
+    def write(self, value):
+        return value
 
 @app.route("/export.csv")
 def export_csv():
-    output = io.StringIO()
     writer = csv.DictWriter(
-        output,
+        _Echo(),
         fieldnames=["ts","level","event","sub","title","url","comment_id","error","seconds","user","count"]
     )
-    writer.writeheader()
-    for row in STATE["logs"]:
-        writer.writerow({k: row.get(k, "") for k in writer.fieldnames})
-    csv_data = output.getvalue()
+    with STATE["_lock"]:
+        logs = list(STATE["logs"])
+
+    def _gen():
+        yield writer.writeheader()
+        for row in logs:
+            yield writer.writerow({k: row.get(k, "") for k in writer.fieldnames})
+
     return Response(
-        csv_data,
+        _gen(),
         mimetype="text/csv",
         headers={"Content-Disposition": "attachment; filename=progress_logs.csv"}
     )
@@ -580,4 +1062,7 @@ def static_files(filename):
     return send_from_directory("static", filename)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)), debug=True)
+    # Local dev only; deploys run gunicorn with a single worker (STATE is in-process).
+    # No reloader: it would fork a second process with its own STATE and workers.
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)),
+            debug=os.environ.get("FLASK_DEBUG") == "1", use_reloader=False, threaded=True)